@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+#
+# loadtest.py
+#
+# Fires concurrent single-ISBN requests at a running `lookup serve`
+# and reports latency along with upstream calls per client request.
+
+import httplib
+import json
+import socket
+import threading
+import time
+import urllib
+import urllib2
+
+import gflags as flags
+import google.apputils.app as app
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('server', 'http://localhost:8080',
+  'Base URL of the lookup server.')
+flags.DEFINE_integer('num_requests', 1000,
+  'Total number of lookup requests to send.')
+flags.DEFINE_integer('concurrency', 32,
+  'Number of client threads sending requests.')
+
+
+def _FetchStats():
+  return json.loads(urllib2.urlopen(FLAGS.server + '/stats').read())
+
+
+def _Percentile(sorted_values, fraction):
+  index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+  return sorted_values[index]
+
+
+def main(argv):
+  if len(argv) != 2:
+    app.usage(shorthelp=1,
+      detailed_error='Incorrect number of arguments, ' +
+      'expected 1 (a file of ISBNs), got %s' % (len(argv) - 1,),
+      exitcode=1)
+  if FLAGS.num_requests < 1:
+    app.usage(shorthelp=1,
+      detailed_error='--num_requests must be at least 1, got %s' % (
+        FLAGS.num_requests,),
+      exitcode=1)
+
+  isbns = [line.strip() for line in open(argv[1]) if line.strip()]
+  if not isbns:
+    print 'No ISBNs found in %s' % (argv[1],)
+    exit(1)
+
+  lock = threading.Lock()
+  latencies = []
+  errors = [0]
+  counter = iter(xrange(FLAGS.num_requests))
+
+  def _Worker():
+    while True:
+      with lock:
+        try:
+          i = counter.next()
+        except StopIteration:
+          return
+      url = '%s/lookup?%s' % (
+        FLAGS.server, urllib.urlencode({'isbn': isbns[i % len(isbns)]}))
+      start = time.time()
+      try:
+        urllib2.urlopen(url).read()
+      except urllib2.HTTPError, e:
+        # A 404 is a valid answer for an unknown ISBN.
+        if e.code != 404:
+          with lock:
+            errors[0] += 1
+          continue
+      except (urllib2.URLError, socket.error, httplib.HTTPException):
+        with lock:
+          errors[0] += 1
+        continue
+      elapsed = time.time() - start
+      with lock:
+        latencies.append(elapsed)
+
+  before = _FetchStats()
+  start = time.time()
+  threads = [threading.Thread(target=_Worker)
+             for _ in xrange(FLAGS.concurrency)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  wall_time = time.time() - start
+  after = _FetchStats()
+
+  latencies.sort()
+  client_requests = after['client_requests'] - before['client_requests']
+  upstream_calls = after['upstream_calls'] - before['upstream_calls']
+  cache_hits = after['cache_hits'] - before['cache_hits']
+  print 'Requests:        %d of %d in %.2fs' % (
+    len(latencies) + errors[0], FLAGS.num_requests, wall_time)
+  print 'Errors:          %d (excluded from latency)' % (errors[0],)
+  if latencies:
+    print 'Latency p50:     %.1f ms' % (1000 * _Percentile(latencies, 0.50),)
+    print 'Latency p99:     %.1f ms' % (1000 * _Percentile(latencies, 0.99),)
+    print 'Latency max:     %.1f ms' % (1000 * latencies[-1],)
+  print 'Cache hits:      %d' % (cache_hits,)
+  print 'Upstream calls:  %d' % (upstream_calls,)
+  if client_requests:
+    print 'Upstream calls per client request: %.3f' % (
+      float(upstream_calls) / client_requests,)
+
+
+if __name__ == '__main__':
+  app.run()
@@ -3,19 +3,24 @@
 # lookup.py
 # 
 
+import BaseHTTPServer
 import base64
 import csv
 import hashlib
 import hmac
+import json
 import locale
 import os
 import platform
 import pprint
 import re
+import SocketServer
 import sys
+import threading
 import time
 import urllib
 import urllib2
+import urlparse
 import xml
 import xml.etree.ElementTree as ElementTree
 
@@ -219,6 +224,18 @@ class AmazonClient(object):
 
   @staticmethod
   def GetSalesInfo(xml_response):
+    results, errors = AmazonClient.ParseSalesInfo(xml_response)
+    if errors:
+      raise ValueError(errors[0])
+    return results
+
+  @staticmethod
+  def ParseSalesInfo(xml_response):
+    """Return (results, error messages) without failing on errors.
+
+    Amazon reports an unknown ItemId as an error alongside the items it
+    did find, so callers that batch ISBNs need both halves.
+    """
     def _FindChildren(xml, tag):
       namespace = re.finditer('{(.*)}.*', xml.tag).next().groups()[0]
       resolved_tags = ['{%s}%s' % (namespace, tag) for tag in tag.split('/')]
@@ -233,16 +250,15 @@ class AmazonClient(object):
         return default
 
     xml = ElementTree.XML(xml_response)
-    # Check for a failed request
-    errors = _FindChildren(xml, 'Errors')
-    if errors:
-      raise ValueError(_FindChild(errors[0], 'Message', '(Unknown error)'))
+    errors = []
+    for error_list in _FindChildren(xml, 'Errors'):
+      messages = [_FindChild(error, 'Message', '(Unknown error)')
+                  for error in _FindChildren(error_list, 'Error')]
+      errors.extend(messages or ['(Unknown error)'])
 
-    results = {}
-    for item in _FindChildren(xml, 'Item'):
+    def _ParseItem(item):
       item_info = {}
-      item_info['sales_rank'] = MaybeSalesRank(
-        _FindChild(item, 'SalesRank', default='(None)'))
+      item_info['sales_rank'] = MaybeSalesRank(_FindChild(item, 'SalesRank'))
       offer_summary = _FindChildren(item, 'OfferSummary')[0]
       item_info['best_used_price'] = MaybePrice(
         _FindChild(offer_summary, 'LowestUsedPrice/Amount'))
@@ -255,9 +271,248 @@ class AmazonClient(object):
       item_info['title'] = _FindChild(item, 'Title')
       item_info['isbn'] = _FindChild(item, 'ASIN')
       item_info['timestamp'] = (int(time.time()) // 1000) * 1000
+      return item_info
+
+    results = {}
+    for item in _FindChildren(xml, 'Item'):
+      # A malformed item is dropped (and so reads as a miss) rather than
+      # failing the other items in the response.
+      try:
+        item_info = _ParseItem(item)
+      except Exception, e:
+        print >>sys.stderr, 'Error parsing item %s: %r' % (
+          _FindChild(item, 'ASIN'), e)
+        continue
       results[item_info['isbn']] = item_info
 
-    return results
+    return results, errors
+
+
+class LookupBusyError(RuntimeError):
+  """Raised when too many ISBNs are already waiting on upstream lookups."""
+
+
+class LookupTimeoutError(RuntimeError):
+  """Raised when an upstream batch does not answer in time."""
+
+
+class _PendingLookup(object):
+  """A single ISBN waiting on an upstream batch."""
+  def __init__(self):
+    self.event = threading.Event()
+    self.result = None
+    self.error = None
+
+
+class LookupBatcher(object):
+  """Gathers single-ISBN lookups into batched upstream requests.
+
+  Callers block in Lookup() while a background thread collects pending
+  ISBNs for up to `window` seconds after the oldest one arrived (or
+  until a full batch is waiting) and issues one LookupIsbns call per
+  batch. Concurrent requests for the same ISBN share a slot, and results
+  (including misses) are cached for `cache_ttl` seconds.
+
+  Upstream calls are made one at a time from a single thread, and
+  successive calls start at least `min_interval` seconds apart to stay
+  within Amazon's per-account request rate limit. To keep that from
+  turning into unbounded latency, at most `max_pending` ISBNs may be
+  waiting at once, and callers give up after `timeout` seconds.
+  """
+  MAX_BATCH_SIZE = 10
+
+  def __init__(self, client, window=0.05, cache_ttl=3600, timeout=30,
+               max_pending=1000, min_interval=1.0):
+    self.client = client
+    self.window = window
+    self.min_interval = min_interval
+    self.next_call = 0
+    self.cache_ttl = cache_ttl
+    self.timeout = timeout
+    self.max_pending = max_pending
+    self.cache = {}
+    self.next_sweep = time.time() + cache_ttl
+    self.pending = {}
+    self.queue = []
+    self.condition = threading.Condition()
+    self.stats = {'client_requests': 0, 'cache_hits': 0, 'rejected': 0,
+                  'upstream_calls': 0}
+    self.worker = threading.Thread(target=self._Run)
+    self.worker.daemon = True
+    self.worker.start()
+
+  def Stats(self):
+    with self.condition:
+      return dict(self.stats)
+
+  def Lookup(self, isbn):
+    isbn = str(isbn)
+    now = time.time()
+    with self.condition:
+      cached = self.cache.get(isbn)
+      if cached is not None:
+        if cached[0] > now:
+          self.stats['client_requests'] += 1
+          self.stats['cache_hits'] += 1
+          return cached[1]
+        del self.cache[isbn]
+      pending = self.pending.get(isbn)
+      if pending is None:
+        if len(self.pending) >= self.max_pending:
+          self.stats['rejected'] += 1
+          raise LookupBusyError('Too many ISBNs waiting on upstream lookups.')
+        pending = _PendingLookup()
+        self.pending[isbn] = pending
+        self.queue.append((now, isbn))
+        self.condition.notify()
+      self.stats['client_requests'] += 1
+    if not pending.event.wait(self.timeout):
+      raise LookupTimeoutError('Timed out waiting for upstream lookup.')
+    if pending.error is not None:
+      raise pending.error
+    return pending.result
+
+  def _NextBatch(self):
+    with self.condition:
+      while not self.queue:
+        self.condition.wait()
+      # Requests that queued up during the previous upstream call have
+      # already waited, so the window runs from the oldest arrival.
+      deadline = self.queue[0][0] + self.window
+      while len(self.queue) < self.MAX_BATCH_SIZE:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          break
+        self.condition.wait(remaining)
+      # Keep gathering while we wait out the rate limit.
+      while True:
+        remaining = self.next_call - time.time()
+        if remaining <= 0:
+          break
+        self.condition.wait(remaining)
+      batch = [isbn for _, isbn in self.queue[:self.MAX_BATCH_SIZE]]
+      self.queue = self.queue[len(batch):]
+      self.next_call = time.time() + self.min_interval
+      self.stats['upstream_calls'] += 1
+      return batch
+
+  def _CacheResults(self, isbns, sales_infos):
+    now = time.time()
+    if now >= self.next_sweep:
+      for isbn, (expiry, _) in self.cache.items():
+        if expiry <= now:
+          del self.cache[isbn]
+      self.next_sweep = now + self.cache_ttl
+    expiry = now + self.cache_ttl
+    for isbn in isbns:
+      self.cache[isbn] = (expiry, sales_infos.get(isbn))
+
+  def _Run(self):
+    while True:
+      batch = self._NextBatch()
+      sales_infos = {}
+      error = None
+      try:
+        response = self.client.LookupIsbns(batch)
+        sales_infos, messages = AmazonClient.ParseSalesInfo(response)
+      except Exception, e:
+        error = e
+      else:
+        # Amazon reports each unknown ItemId as its own error and still
+        # returns the rest of the batch; those ISBNs are simply misses.
+        # An error we can't pin on an ISBN fails the whole batch.
+        for message in messages:
+          if not any(isbn in message for isbn in batch):
+            error = ValueError(message)
+            break
+      if error is not None:
+        print >>sys.stderr, 'Error looking up %s: %s' % (','.join(batch), error)
+      # ISBNs stay in self.pending until the cache is filled, so any
+      # request arriving mid-flight joins this batch instead of
+      # queueing a second upstream call.
+      with self.condition:
+        if error is None:
+          self._CacheResults(batch, sales_infos)
+        waiting = [(isbn, self.pending.pop(isbn)) for isbn in batch]
+      for isbn, pending in waiting:
+        pending.result = sales_infos.get(isbn)
+        pending.error = error
+        pending.event.set()
+
+
+def _ItemInfoAsDict(item_info):
+  result = {
+    'isbn': item_info['isbn'],
+    'title': item_info['title'],
+    'sales_rank': item_info['sales_rank'].rank,
+    'timestamp': item_info['timestamp'],
+    }
+  for key in ('amazon_price', 'best_price', 'best_new_price',
+              'best_used_price'):
+    result[key] = item_info[key].price
+  return result
+
+
+class _LookupRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Answers GET /lookup?isbn=... and GET /stats with JSON."""
+  def _SendJson(self, code, value):
+    body = json.dumps(value)
+    self.send_response(code)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_GET(self):
+    path, _, query = self.path.partition('?')
+    batcher = self.server.batcher
+    if path == '/stats':
+      self._SendJson(200, batcher.Stats())
+      return
+    if path != '/lookup':
+      self._SendJson(404, {'error': 'Unknown path: %s' % (path,)})
+      return
+    raw_isbns = urlparse.parse_qs(query).get('isbn')
+    if not raw_isbns:
+      self._SendJson(400, {'error': 'Missing isbn parameter.'})
+      return
+    try:
+      isbn = Isbn(raw_isbns[0])
+    except ValueError, e:
+      self._SendJson(400, {'error': str(e)})
+      return
+    try:
+      item_info = batcher.Lookup(isbn)
+    except LookupBusyError, e:
+      self._SendJson(503, {'error': str(e)})
+      return
+    except LookupTimeoutError, e:
+      self._SendJson(504, {'error': str(e)})
+      return
+    except Exception:
+      # Details (which may include the signed upstream URL) are logged
+      # by the batcher; don't hand them to clients.
+      self._SendJson(502, {'error': 'Error looking up ISBN upstream.'})
+      return
+    if item_info is None:
+      self._SendJson(404, {'error': 'ISBN not found: %s' % (isbn,)})
+      return
+    self._SendJson(200, _ItemInfoAsDict(item_info))
+
+  def log_message(self, fmt, *args):
+    if FLAGS.log_requests:
+      BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, fmt, *args)
+
+
+class _LookupServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  # The SocketServer default of 5 overflows under concurrent clients, and
+  # the resulting SYN retransmits dominate tail latency.
+  request_queue_size = 128
+
+  def __init__(self, address, batcher):
+    BaseHTTPServer.HTTPServer.__init__(self, address, _LookupRequestHandler)
+    self.batcher = batcher
 
 
 class EncodeUrlCmd(appcommands.Cmd):
@@ -395,6 +650,50 @@ class LookupAllCmd(appcommands.Cmd):
           self.PrintItem(isbn, sales_infos.get(isbn))
 
 
+class ServeCmd(appcommands.Cmd):
+  """Serve single-ISBN lookups as JSON over HTTP, batching upstream calls."""
+  def __init__(self, argv, fv):
+    super(ServeCmd, self).__init__(argv, fv)
+    flags.DEFINE_string('host', 'localhost',
+      'Address to listen on.')
+    flags.DEFINE_integer('port', 8080,
+      'Port to listen on.')
+    flags.DEFINE_integer('batch_window_ms', 50,
+      'How long to gather requests before issuing an upstream lookup.')
+    flags.DEFINE_integer('cache_ttl', 3600,
+      'Seconds to keep lookup results before asking amazon again.')
+    flags.DEFINE_integer('lookup_timeout', 30,
+      'Seconds a request may wait on an upstream lookup before failing.')
+    flags.DEFINE_integer('max_pending', 1000,
+      'Maximum ISBNs waiting on upstream lookups before rejecting requests.')
+    flags.DEFINE_integer('min_upstream_interval_ms', 1000,
+      'Minimum time between the starts of successive upstream lookups.')
+    flags.DEFINE_boolean('log_requests', False,
+      'Log each incoming request to stderr.')
+
+  def Run(self, argv):
+    if len(argv) != 1:
+      app.usage(shorthelp=1,
+        detailed_error='Incorrect number of arguments, ' +
+        'expected 0, got %s' % (len(argv) - 1,),
+        exitcode=1)
+
+    batcher = LookupBatcher(
+      Client(),
+      window=FLAGS.batch_window_ms / 1000.0,
+      cache_ttl=FLAGS.cache_ttl,
+      timeout=FLAGS.lookup_timeout,
+      max_pending=FLAGS.max_pending,
+      min_interval=FLAGS.min_upstream_interval_ms / 1000.0)
+    server = _LookupServer((FLAGS.host, FLAGS.port), batcher)
+    print 'Serving on http://%s:%s/lookup?isbn=...' % (FLAGS.host, FLAGS.port)
+    try:
+      server.serve_forever()
+    except KeyboardInterrupt:
+      pass
+    server.server_close()
+
+
 class ValidateIsbnCmd(appcommands.Cmd):
   """Validate an ISBN."""
   def Run(self, argv):
@@ -444,6 +743,7 @@ def main(argv):
   appcommands.AddCmd('batch', LookupAllCmd)
   appcommands.AddCmd('encode', EncodeUrlCmd)
   appcommands.AddCmd('lookup', LookupIsbnCmd)
+  appcommands.AddCmd('serve', ServeCmd)
   appcommands.AddCmd('validate_isbn', ValidateIsbnCmd)
   appcommands.AddCmd('verify', VerifyCmd)
 
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+#
+# lookup_test.py
+#
+
+import threading
+import time
+import unittest
+
+import lookup
+
+_NAMESPACE = 'http://webservices.amazon.com/AWSECommerceService/2010-09-01'
+_UNKNOWN_ISBN = '0000000000'
+_ISBNS = [str(lookup.Isbn('%09d0' % (100000000 + i,))) for i in range(12)]
+
+
+def _ItemXml(isbn, sales_rank='1234', offer_summary=True):
+  parts = ['<Item><ASIN>%s</ASIN>' % (isbn,)]
+  if sales_rank is not None:
+    parts.append('<SalesRank>%s</SalesRank>' % (sales_rank,))
+  parts.append('<ItemAttributes><Title>Title %s</Title></ItemAttributes>' %
+               (isbn,))
+  if offer_summary:
+    parts.append('<OfferSummary><LowestNewPrice><Amount>1500</Amount>'
+                 '</LowestNewPrice><LowestUsedPrice><Amount>700</Amount>'
+                 '</LowestUsedPrice></OfferSummary>')
+  parts.append('</Item>')
+  return ''.join(parts)
+
+
+def _ResponseXml(items, errors=()):
+  error_xml = ''
+  if errors:
+    error_xml = '<Errors>%s</Errors>' % (''.join(
+      '<Error><Code>AWS.InvalidParameterValue</Code>'
+      '<Message>%s</Message></Error>' % (message,) for message in errors),)
+  return ('<ItemLookupResponse xmlns="%s"><Items><Request>%s</Request>%s'
+          '</Items></ItemLookupResponse>' % (
+            _NAMESPACE, error_xml, ''.join(items)))
+
+
+class FakeClient(object):
+  """Answers LookupIsbns like Amazon, recording each batch it sees."""
+  def __init__(self, delay=0, unranked=(), malformed=()):
+    self.delay = delay
+    self.unranked = unranked
+    self.malformed = malformed
+    self.calls = []
+    self.release = None
+
+  def LookupIsbns(self, isbns):
+    self.calls.append((time.time(), list(isbns)))
+    if self.release is not None:
+      self.release.wait()
+    time.sleep(self.delay)
+    items = []
+    errors = []
+    for isbn in isbns:
+      if isbn == _UNKNOWN_ISBN:
+        errors.append('%s is not a valid value for ItemId. Please change '
+                      'this value and retry your request.' % (isbn,))
+      elif isbn in self.unranked:
+        items.append(_ItemXml(isbn, sales_rank=None))
+      elif isbn in self.malformed:
+        items.append(_ItemXml(isbn, offer_summary=False))
+      else:
+        items.append(_ItemXml(isbn))
+    return _ResponseXml(items, errors)
+
+
+def _LookupConcurrently(batcher, isbns):
+  results = [None] * len(isbns)
+
+  def _Lookup(index):
+    try:
+      results[index] = batcher.Lookup(isbns[index])
+    except Exception, e:
+      results[index] = e
+
+  threads = [threading.Thread(target=_Lookup, args=(i,))
+             for i in range(len(isbns))]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return results
+
+
+class ParseSalesInfoTest(unittest.TestCase):
+
+  def testItemsAndErrorsAreSeparated(self):
+    response = _ResponseXml([_ItemXml(_ISBNS[0])],
+                            ['%s is not a valid value for ItemId.' %
+                             (_UNKNOWN_ISBN,)])
+    results, errors = lookup.AmazonClient.ParseSalesInfo(response)
+    self.assertEqual([_ISBNS[0]], results.keys())
+    self.assertEqual(1, len(errors))
+    self.assertTrue(_UNKNOWN_ISBN in errors[0])
+    self.assertRaises(ValueError, lookup.AmazonClient.GetSalesInfo, response)
+
+  def testUnrankedItemHasUndefinedSalesRank(self):
+    response = _ResponseXml([_ItemXml(_ISBNS[0], sales_rank=None)])
+    results, _ = lookup.AmazonClient.ParseSalesInfo(response)
+    self.assertFalse(results[_ISBNS[0]]['sales_rank'].defined)
+    self.assertEqual(700, results[_ISBNS[0]]['best_price'].price)
+
+  def testMalformedItemIsDropped(self):
+    response = _ResponseXml([_ItemXml(_ISBNS[0], offer_summary=False),
+                             _ItemXml(_ISBNS[1])])
+    results, errors = lookup.AmazonClient.ParseSalesInfo(response)
+    self.assertEqual([_ISBNS[1]], results.keys())
+    self.assertEqual([], errors)
+
+
+class LookupBatcherTest(unittest.TestCase):
+
+  def _Batcher(self, client, **kwds):
+    kwds.setdefault('window', 0.2)
+    kwds.setdefault('min_interval', 0)
+    return lookup.LookupBatcher(client, **kwds)
+
+  def testUnknownIsbnIsMissWithoutFailingBatch(self):
+    client = FakeClient()
+    batcher = self._Batcher(client)
+    isbns = _ISBNS[:3] + [_UNKNOWN_ISBN]
+    results = _LookupConcurrently(batcher, isbns)
+    self.assertEqual(1, len(client.calls))
+    self.assertEqual(_ISBNS[:3], [info['isbn'] for info in results[:3]])
+    self.assertEqual(None, results[3])
+    # The miss is cached, so it doesn't take a slot in later batches.
+    self.assertEqual(None, batcher.Lookup(_UNKNOWN_ISBN))
+    self.assertEqual(1, len(client.calls))
+
+  def testBadItemDoesNotFailBatchMates(self):
+    client = FakeClient(unranked=[_ISBNS[0]], malformed=[_ISBNS[1]])
+    batcher = self._Batcher(client)
+    results = _LookupConcurrently(batcher, _ISBNS[:3])
+    self.assertEqual(1, len(client.calls))
+    self.assertEqual(_ISBNS[0], results[0]['isbn'])
+    self.assertFalse(results[0]['sales_rank'].defined)
+    self.assertEqual(None, results[1])
+    self.assertEqual(_ISBNS[2], results[2]['isbn'])
+
+  def testDuplicateIsbnsShareUpstreamCall(self):
+    client = FakeClient()
+    batcher = self._Batcher(client)
+    results = _LookupConcurrently(batcher, [_ISBNS[0]] * 5 + [_ISBNS[1]] * 5)
+    self.assertEqual(1, len(client.calls))
+    self.assertEqual(sorted(_ISBNS[:2]), sorted(client.calls[0][1]))
+    self.assertEqual([_ISBNS[0]] * 5 + [_ISBNS[1]] * 5,
+                     [info['isbn'] for info in results])
+    stats = batcher.Stats()
+    self.assertEqual(10, stats['client_requests'])
+    self.assertEqual(1, stats['upstream_calls'])
+
+  def testFullBatchIsSentBeforeWindowCloses(self):
+    client = FakeClient()
+    batcher = self._Batcher(client, window=10)
+    start = time.time()
+    _LookupConcurrently(batcher, _ISBNS[:10])
+    self.assertTrue(time.time() - start < 5)
+    self.assertEqual([sorted(_ISBNS[:10])],
+                     [sorted(isbns) for _, isbns in client.calls])
+
+  def testUpstreamCallsRespectMinInterval(self):
+    client = FakeClient()
+    batcher = self._Batcher(client, window=0, min_interval=0.3)
+    batcher.Lookup(_ISBNS[0])
+    batcher.Lookup(_ISBNS[1])
+    self.assertEqual(2, len(client.calls))
+    self.assertTrue(client.calls[1][0] - client.calls[0][0] >= 0.3)
+
+  def testBusyWhenTooManyPending(self):
+    client = FakeClient()
+    client.release = threading.Event()
+    batcher = self._Batcher(client, window=0, max_pending=1)
+    waiter = threading.Thread(target=batcher.Lookup, args=(_ISBNS[0],))
+    waiter.start()
+    while not client.calls:
+      time.sleep(0.01)
+    try:
+      self.assertRaises(lookup.LookupBusyError, batcher.Lookup, _ISBNS[1])
+    finally:
+      client.release.set()
+      waiter.join()
+    stats = batcher.Stats()
+    self.assertEqual(1, stats['client_requests'])
+    self.assertEqual(1, stats['rejected'])
+
+  def testTimeoutWhenUpstreamIsSlow(self):
+    client = FakeClient()
+    client.release = threading.Event()
+    batcher = self._Batcher(client, window=0, timeout=0.1)
+    try:
+      self.assertRaises(lookup.LookupTimeoutError, batcher.Lookup, _ISBNS[0])
+    finally:
+      client.release.set()
+
+
+if __name__ == '__main__':
+  unittest.main()